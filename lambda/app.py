@@ -1,144 +1,307 @@
 """
 AWS Lambda function to identify non-main branches in GitHub repositories across all organizations owned by the
-authenticated user, indicating whether each branch is older than 72 hours, with a formatted hierarchical report and
-repository count.
+authenticated user, indicating whether each branch is older than 72 hours, with a formatted hierarchical report of
+what changed since the previous run and a repository count.
 
 This function:
-- Retrieves a GitHub Personal Access Token (PAT) from AWS Secrets Manager.
-- Uses the PAT to authenticate with the GitHub API via PyGithub.
+- Retrieves a GitHub Personal Access Token (PAT) from AWS Secrets Manager, once per Lambda container.
+- Uses the PAT to authenticate with the GitHub REST and GraphQL APIs via aiohttp.
 - Fetches all organizations owned by the user.
-- Iterates through all repositories in these organizations (expected ~200 repos).
-- Identifies branches other than 'main' and checks if their HEAD commit is older than 72 hours based on committer.date.
-- Sends a multipart email (HTML and plain-text) with a hierarchical report of non-main branches and a count of
-processed repositories, via AWS SES.
+- Processes organizations, and the repositories within each of them (expected ~200 repos), concurrently with asyncio,
+with at most 10 GitHub requests in flight at a time.
+- Skips archived and empty repositories, and does not fetch branches of repositories that only have their default
+branch.
+- Loads the previous run's state (each repo's pushedAt, default branch and branches with their HEAD commit dates) from
+S3, in parallel with the PAT; repos not pushed to since then reuse their stored branches, the others have their
+branches and HEAD commit dates fetched in batches of 20 repos per GraphQL query (one aliased repository field per
+repo); branches past the first 100 of a repo are fetched page by page.
+- Diffs each repo's branches against the previous run as soon as they arrive, while the crawl continues, and stores
+the new state in S3 once the report is sent.
+- Identifies branches other than each repo's default branch (e.g., 'main' or 'master', from defaultBranchRef) and checks
+if their HEAD commit is older than 72 hours based on committedDate.
+- Sends a multipart email (HTML and plain-text) with a hierarchical report of the non-main branches that were added,
+removed, or became (or stopped being) stale since the previous run, and a count of processed repositories, via AWS SES.
 - Lists each organization once, followed by its repositories (indented), and their branches (further indented) with
-+72hrs status (Y/N).
-- Includes the day and date (e.g., 'Wednesday, July 02, 2025') in the email subject line.
++72hrs status (Y/N) and the change.
+- Includes the day and date (e.g., 'Wednesday, July 02, 2025', in UTC) in the email subject line.
 - Logs each organization and repository being processed to CloudWatch via print statements.
-- Handles GitHub API rate limits by pausing if remaining requests drop below 100.
+- Handles GitHub API rate limits and transient errors by retrying with exponential backoff.
 - Is designed to be triggered by a CloudWatch Events schedule (e.g., daily).
 
 Environment Variables:
 - GITHUB_SECRET_NAME: Name of the Secrets Manager secret containing the GitHub PAT (e.g., 'github-token').
 - SENDER_EMAIL: SES-verified email address to send the report from (e.g., 'tennis.n.smith@gmail.com').
 - RECIPIENT_EMAIL: Email address to receive the report.
+- STATE_BUCKET: S3 bucket holding the state of the previous run.
+- STATE_KEY (optional): S3 key of the state object (default: 'state/latest.json').
 
 Dependencies:
-- boto3: For AWS Secrets Manager and SES interactions.
-- PyGithub: For GitHub API interactions (provided via Lambda layer or package).
+- boto3: For AWS Secrets Manager, S3 and SES interactions.
+- aiohttp: For asynchronous GitHub API interactions (provided via Lambda layer or package).
+- Jinja2: For rendering the HTML and plain-text reports (provided via Lambda layer or package).
 - Python 3.12 runtime.
 
 GitHub PAT Requirements:
 - Scopes: 'read:org' (to list organizations), 'repo' (for private repos) or 'public_repo' (for public repos).
 - Stored in Secrets Manager as JSON: {"github_token": "your-pat"}.
+- The PAT is cached while the Lambda container stays warm; after rotating it, update the function configuration (or
+wait for a cold start) to pick up the new value.
 
 IAM Permissions Required:
 - secretsmanager:GetSecretValue: To retrieve the GitHub PAT.
+- s3:GetObject, s3:PutObject: To read and store the state of the previous run.
+- s3:ListBucket: So a missing state object on the first run is reported as NoSuchKey rather than AccessDenied.
 - ses:SendEmail: To send the report via SES.
 - AWSLambdaBasicExecutionRole: For CloudWatch Logs.
 
 Rate Limit Handling:
-- Checks GitHub API rate limit before processing organizations, repositories, and commits.
-- Pauses execution if remaining requests < 100 until the limit resets.
-- Expected ~2,210 API calls for 200 repos (~1,000 branches), within 5,000/hour limit.
+- Reads the remaining quota from the X-RateLimit-Remaining header of every GitHub response, so no extra calls are
+spent checking the rate limit, and logs when it drops below 100.
+- Retries requests answered with 429, 500, 502, 503 or 504, or with a rate limited 403 (Retry-After present or
+X-RateLimit-Remaining of 0), after the Retry-After header's delay when present, otherwise with exponential backoff
+(1s, 2s, 4s, 8s, 16s, +/-20% jitter), for at most 6 attempts. Other 403s (e.g., missing permissions or SSO
+authorization) fail immediately. A 403 or 429 with no quota left and no Retry-After is only retried once the limit
+resets, and only if that happens within the retry budget; otherwise it fails immediately.
+- Each request may wait at most 60s in total between its retries, and no retry is started later than 30s before the
+Lambda timeout, so the report is still sent and the state saved. Requests that still fail are handled as errors (see
+Error Handling). Waiting requests release their concurrency slot to other requests.
+- On a day without pushes only the /user/orgs REST call (one per 100 organizations) and the repo listing queries (one
+per 100 repos of each organization) are made; repos pushed to since the previous run cost one more GraphQL query per
+batch of up to 20 such repos of the same organization, plus one per further 100 branches of a repo.
 
 Error Handling:
-- Catches and logs (via print) errors at the organization, repository, branch, and commit levels.
-- Continues processing remaining orgs/repos if individual failures occur.
+- Catches and logs (via print) errors at the organization and repository levels.
+- Archived and empty repositories are logged as skipped and are not included in the repository count.
+- Continues processing remaining orgs/repos if individual failures occur; orgs and repos that could not be fetched
+keep their previous state, so they are not reported as removed and are retried on the next run.
 - Returns HTTP 500 status code on unhandled exceptions.
 
 Logging:
 - Prints each organization and repository as they are processed (e.g., 'Processing organization: myorg1', 'Processing
-repo: repo1 in myorg1').
+repo: repo1 in myorg1'); with concurrent processing these lines may interleave across organizations.
 - Logs errors and email success to CloudWatch via print statements.
 
 Output:
 - Sends a multipart email with:
   - HTML: Org in <h3>, repos in <p> with margin-left: 20px, branches in <p> with margin-left: 40px, format: <branch>,
-  Y/N, followed by repository count.
-  - Plain-text: Org as header, repos indented with 4 spaces, branches indented with 8 spaces, format: <branch>, Y/N,
-  followed by repository count.
+  Y/N (<change>), followed by repository count. Org, repo and branch names are HTML-escaped.
+  - Plain-text: Org as header, repos indented with 4 spaces, branches indented with 8 spaces, format: <branch>, Y/N
+  (<change>), followed by repository count.
+  - Change: 'new', 'removed', 'now stale' or 'updated' (a new commit made a stale branch fresh again). On the first
+  run, with no previous state, every branch is reported as new.
   - Subject: Includes day and date, e.g., 'GitHub Non-Main Branches Report - Wednesday, July 02, 2025'.
   Example:
     myorg1
         repo1
-            dev, Y
-            feature/x, N
+            dev, Y (now stale)
+            feature/x, N (new)
         repo2
-            test, Y
+            test, Y (removed)
     org_name_with_length
         repo3
-            staging, Y
+            staging, N (updated)
         repo4
-            test2, N
+            test2, N (new)
     Total repositories processed: 200
-- If no non-main branches are found, sends: "No non-main branches found as of <timestamp>." with the repository count.
+- If no branches changed, sends: "No non-main branch changes since the last run as of <timestamp>." with the
+repository count.
 
 Setup Notes:
-- Lambda timeout: 5 minutes (sufficient for ~200 repos, ~2-3 minutes execution with commit checks).
+- Lambda timeout: 5 minutes (sufficient for ~200 repos; requests are issued concurrently).
 - Lambda memory: 512 MB.
-- PyGithub layer: arn:aws:lambda:<region>:770693421928:layer:Klayers-p39-github:1.
+- Dependencies: package the modules in requirements.txt with the function or provide them as a Lambda layer.
+- S3: Create the state bucket; the state object is created on the first run.
 - SES: Sender and recipient emails must be verified in us-east-1 (if in sandbox mode).
 - CloudWatch: Schedule with 'rate(1 day)' for daily execution.
 
 Example Email Output (Plain-text):
   Subject: GitHub Non-Main Branches Report - Wednesday, July 02, 2025
-  Non-main branches found as of 2025-07-02T15:58:00:
+  Non-main branch changes since the last run as of 2025-07-02T15:58:00+00:00:
   myorg1
       repo1
-          dev, Y
-          feature/x, N
+          dev, Y (now stale)
+          feature/x, N (new)
       repo2
-          test, Y
+          test, Y (removed)
   org_name_with_length
       repo3
-          staging, Y
+          staging, N (updated)
       repo4
-          test2, N
+          test2, N (new)
   Total repositories processed: 200
 Example HTML Output (rendered):
-  <p>Non-main branches found as of 2025-07-02T15:58:00:</p>
+  <p>Non-main branch changes since the last run as of 2025-07-02T15:58:00+00:00:</p>
   <div style="font-family: Arial, sans-serif;">
   <h3>myorg1</h3>
   <p style="margin-left: 20px;">repo1</p>
-  <p style="margin-left: 40px;">dev, Y</p>
-  <p style="margin-left: 40px;">feature/x, N</p>
+  <p style="margin-left: 40px;">dev, Y (now stale)</p>
+  <p style="margin-left: 40px;">feature/x, N (new)</p>
   <p style="margin-left: 20px;">repo2</p>
-  <p style="margin-left: 40px;">test, Y</p>
+  <p style="margin-left: 40px;">test, Y (removed)</p>
   <h3>org_name_with_length</h3>
   <p style="margin-left: 20px;">repo3</p>
-  <p style="margin-left: 40px;">staging, Y</p>
+  <p style="margin-left: 40px;">staging, N (updated)</p>
   <p style="margin-left: 20px;">repo4</p>
-  <p style="margin-left: 40px;">test2, N</p>
+  <p style="margin-left: 40px;">test2, N (new)</p>
   <p>Total repositories processed: 200</p>
   </div>
 """
 
+import asyncio
+import contextlib
+import functools
 import json
 import os
+import random
 import time
-from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from itertools import groupby
+from operator import itemgetter
+from typing import NamedTuple
 
+import aiohttp
 import boto3
-from github import Github
+import jinja2
+
+# AWS clients are created once per container and reused across warm invocations
+_SECRETS = boto3.client('secretsmanager')
+_SES = boto3.client('ses')
+_S3 = boto3.client('s3')
+
+GITHUB_API_URL = 'https://api.github.com'
+GITHUB_GRAPHQL_URL = 'https://api.github.com/graphql'
+STALE_AFTER = timedelta(hours=72)  # Branches whose HEAD commit is older than this are reported as stale
+MAX_CONCURRENT_REQUESTS = 10  # Bounds in-flight GitHub calls to stay clear of secondary rate limits
+RETRY_STATUSES = (429, 500, 502, 503, 504)  # Rate limited or transient server errors, see retry_delay for 403s
+MAX_ATTEMPTS = 6  # Attempts per GitHub request before giving up
+RETRY_BUDGET = 60  # Total seconds a single GitHub request may spend waiting between its retries
+DEADLINE_MARGIN = 30  # Seconds kept free before the Lambda timeout to send the report and save the state
+
+# Monotonic time after which GitHub requests are no longer retried, set by lambda_handler from the remaining run time
+_retry_deadline = [None]
+
+DEFAULT_STATE_KEY = 'state/latest.json'
+
+# One page of an organization's repositories with what is needed to skip those that have no branches to audit
+ORG_REPOS_QUERY = """
+query($org: String!, $cursor: String) {
+  organization(login: $org) {
+    repositories(first: 100, after: $cursor) {
+      pageInfo { endCursor hasNextPage }
+      nodes {
+        name
+        isArchived
+        pushedAt
+        defaultBranchRef { name }
+        refs(refPrefix: "refs/heads/") { totalCount }
+      }
+    }
+  }
+}
+"""
+
+# One page of branches with their HEAD commit dates
+REFS_PAGE_FIELDS = 'pageInfo { endCursor hasNextPage } nodes { name target { ... on Commit { committedDate } } }'
+
+# Selection of a repository's first page of branches, aliased once per repo in a batched query
+REPO_BRANCHES_FIELDS = f'refs(refPrefix: "refs/heads/", first: 100) {{ {REFS_PAGE_FIELDS} }}'
+
+# A further page of a repository's branches, for repos with more than 100 branches
+REPO_BRANCHES_PAGE_QUERY = f"""
+query($org: String!, $repo: String!, $cursor: String) {{
+  repository(owner: $org, name: $repo) {{
+    refs(refPrefix: "refs/heads/", first: 100, after: $cursor) {{ {REFS_PAGE_FIELDS} }}
+  }}
+}}
+"""
+REPO_BATCH_SIZE = 20  # Repos per batched GraphQL query, keeps each query well under the node-cost limit
+
+# Report templates, rendered with changes (grouped as [(org, [(repo, [Branch, ...]), ...]), ...]), ts and count
+TEXT_REPORT_TEMPLATE = """\
+{% if changes %}
+Non-main branch changes since the last run as of {{ ts }}:
+
+{% for org_name, repos in changes %}
+{{ org_name }}
+{% for repo_name, repo_branches in repos %}
+    {{ repo_name }}
+{% for branch in repo_branches %}
+        {{ branch.branch }}, {{ 'Y' if branch.stale else 'N' }} ({{ branch.change }})
+{% endfor %}
+{% endfor %}
+{% endfor %}
+
+Total repositories processed: {{ count }}
+{% else %}
+No non-main branch changes since the last run as of {{ ts }}.
+
+Total repositories processed: {{ count }}
+{% endif %}
+"""
+
+HTML_REPORT_TEMPLATE = """\
+{% if changes %}
+<p>Non-main branch changes since the last run as of {{ ts }}:</p>
+<div style="font-family: Arial, sans-serif;">
+{% for org_name, repos in changes %}
+<h3>{{ org_name }}</h3>
+{% for repo_name, repo_branches in repos %}
+<p style="margin-left: 20px;">{{ repo_name }}</p>
+{% for branch in repo_branches %}
+<p style="margin-left: 40px;">{{ branch.branch }}, {{ 'Y' if branch.stale else 'N' }} ({{ branch.change }})</p>
+{% endfor %}
+{% endfor %}
+{% endfor %}
+<p>Total repositories processed: {{ count }}</p>
+</div>
+{% else %}
+<p>No non-main branch changes since the last run as of {{ ts }}.</p>
+<p>Total repositories processed: {{ count }}</p>
+{% endif %}
+"""
+
+# Templates are compiled once per container; only the HTML report escapes branch, repo and org names
+_TEXT_REPORT = jinja2.Environment(trim_blocks=True, lstrip_blocks=True).from_string(TEXT_REPORT_TEMPLATE)
+_HTML_REPORT = jinja2.Environment(
+    autoescape=True, trim_blocks=True, lstrip_blocks=True
+).from_string(HTML_REPORT_TEMPLATE)
+
+
+class Branch(NamedTuple):
+    """A changed non-main branch; tuple ordering sorts by org, repo, then branch name"""
+    org: str
+    repo: str
+    branch: str
+    stale: bool
+    change: str  # 'new', 'removed', 'now stale' or 'updated' (no longer stale)
+
+
+# Group keys over Branch tuples
+ORG = itemgetter(0)
+REPO = itemgetter(1)
 
 
 def get_secret(secret_name):
     """Retrieve secret from AWS Secrets Manager"""
-    client = boto3.client('secretsmanager')
     try:
-        response = client.get_secret_value(SecretId=secret_name)
+        response = _SECRETS.get_secret_value(SecretId=secret_name)
         return json.loads(response['SecretString'])
     except Exception as e:
         print(f"Error retrieving secret: {str(e)}")
         raise e
 
 
+@functools.lru_cache(maxsize=1)
+def get_github_token():
+    """Retrieve the GitHub PAT, cached for the lifetime of the Lambda container"""
+    return get_secret(os.environ['GITHUB_SECRET_NAME'])['github_token']
+
+
 def send_email(sender, recipient, subject, html_body, text_body):
     """Send multipart email (HTML and plain-text) via AWS SES"""
-    ses = boto3.client('ses')
     try:
-        ses.send_email(
+        _SES.send_email(
             Source=sender,
             Destination={'ToAddresses': [recipient]},
             Message={
@@ -154,119 +317,350 @@ def send_email(sender, recipient, subject, html_body, text_body):
         print(f"Error sending email: {str(e)}")
         raise e
 
-def check_rate_limit(github_client):
-    """Check GitHub API rate limit and pause if needed"""
-    rate_limit = github_client.get_rate_limit().core
-    if rate_limit.remaining < 100:  # Buffer to avoid hitting limit
-        reset_time = rate_limit.reset.timestamp()
-        sleep_time = reset_time - time.time() + 10  # Add buffer
-        if sleep_time > 0:
-            print(f"Rate limit low ({rate_limit.remaining}). Sleeping for {sleep_time} seconds.")
-            time.sleep(sleep_time)
-    return rate_limit.remaining
+def load_state():
+    """Load the previous run's state from S3, or None if there is none yet"""
+    try:
+        response = _S3.get_object(
+            Bucket=os.environ['STATE_BUCKET'],
+            Key=os.environ.get('STATE_KEY', DEFAULT_STATE_KEY)
+        )
+        return json.loads(response['Body'].read())
+    except _S3.exceptions.NoSuchKey:
+        print("No previous state found, reporting all branches as new")
+        return None
+    except Exception as e:
+        print(f"Error loading state: {str(e)}")
+        raise e
 
-def lambda_handler(event, context):
-    """Lambda handler function"""
+def save_state(state):
+    """Store this run's state in S3 for the next run to diff against"""
     try:
-        # Environment variables
-        github_secret_name = os.environ['GITHUB_SECRET_NAME']
-        sender_email = os.environ['SENDER_EMAIL']
-        recipient_email = os.environ['RECIPIENT_EMAIL']
+        _S3.put_object(
+            Bucket=os.environ['STATE_BUCKET'],
+            Key=os.environ.get('STATE_KEY', DEFAULT_STATE_KEY),
+            Body=json.dumps(state).encode('utf-8'),
+            ContentType='application/json'
+        )
+    except Exception as e:
+        print(f"Error saving state: {str(e)}")
+        raise e
+
+def log_rate_limit(headers):
+    """Log when the rate limit reported in GitHub response headers runs low"""
+    remaining = headers.get('X-RateLimit-Remaining')
+    if remaining is not None and int(remaining) < 100:
+        print(f"Rate limit low ({remaining}), resets at {headers.get('X-RateLimit-Reset')}")
+
+def retry_delay(response, attempt):
+    """Return the seconds to wait before retrying a GitHub response, or None if it is not worth retrying"""
+    retry_after = response.headers.get('Retry-After')
+    if retry_after is not None:
+        return float(retry_after)
+    if response.status in (403, 429) and response.headers.get('X-RateLimit-Remaining') == '0':
+        # Primary limit exhausted; backoff cannot succeed before it resets
+        reset = response.headers.get('X-RateLimit-Reset')
+        return max(0.0, int(reset) - time.time() + 1) if reset is not None else None
+    if response.status in RETRY_STATUSES:
+        # Exponential backoff (1s, 2s, 4s, 8s, 16s) with +/-20% jitter so concurrent requests do not retry in lockstep
+        return 2 ** attempt * (0.8 + random.random() * 0.4)
+    # Permission and SSO 403s fail fast
+    return None
+
+def within_retry_budget(waited, delay):
+    """Return whether waiting delay more seconds keeps a request within its retry budget and the run deadline"""
+    deadline = _retry_deadline[0]
+    return waited + delay <= RETRY_BUDGET and (deadline is None or time.monotonic() + delay < deadline)
+
+async def gh_request(session, method, url, semaphore=None, **kwargs):
+    """Send a GitHub API request and return its JSON payload, retrying rate limit and server errors with backoff"""
+    waited = 0.0
+    for attempt in range(MAX_ATTEMPTS):
+        # The concurrency slot is only held while the request is in flight, not while waiting to retry
+        async with semaphore or contextlib.nullcontext():
+            async with session.request(method, url, **kwargs) as response:
+                delay = retry_delay(response, attempt) if attempt < MAX_ATTEMPTS - 1 else None
+                if delay is None or not within_retry_budget(waited, delay):
+                    response.raise_for_status()
+                    payload = await response.json()
+                    log_rate_limit(response.headers)
+                    return payload
+                status = response.status
+        print(f"GitHub returned {status} for {url}. Retrying in {delay:.1f} seconds.")
+        await asyncio.sleep(delay)
+        waited += delay
+
+async def run_graphql_query(session, query, variables, semaphore=None):
+    """Run a query against the GitHub GraphQL API and return its data"""
+    payload = await gh_request(
+        session, 'POST', GITHUB_GRAPHQL_URL, semaphore, json={'query': query, 'variables': variables}
+    )
+    if payload.get('errors'):
+        raise RuntimeError(f"GraphQL errors: {payload['errors']}")
+    return payload['data']
 
-        # Get GitHub token from Secrets Manager
-        secrets = get_secret(github_secret_name)
-        github_token = secrets['github_token']
+async def fetch_orgs(session):
+    """Fetch the logins of all organizations the authenticated user belongs to"""
+    orgs = []
+    page = 1
+    while True:
+        batch = await gh_request(session, 'GET', f"{GITHUB_API_URL}/user/orgs", params={'per_page': 100, 'page': page})
+        orgs.extend(org['login'] for org in batch)
+        if len(batch) < 100:
+            return orgs
+        page += 1
 
-        # Initialize GitHub client
-        g = Github(github_token)
+async def fetch_org_repos(session, semaphore, org_login):
+    """Fetch all repositories in an organization, skipping archived and empty ones"""
+    repos = []
+    cursor = None
+    while True:
+        data = await run_graphql_query(session, ORG_REPOS_QUERY, {'org': org_login, 'cursor': cursor}, semaphore)
+        repositories = data['organization']['repositories']
+        for repo in repositories['nodes']:
+            if repo['isArchived']:
+                print(f"Skipping archived repo: {repo['name']} in {org_login}")
+            elif repo['defaultBranchRef'] is None:
+                print(f"Skipping empty repo: {repo['name']} in {org_login}")
+            else:
+                repos.append(repo)
+        if not repositories['pageInfo']['hasNextPage']:
+            return repos
+        cursor = repositories['pageInfo']['endCursor']
 
-        # Collect non-main branches, grouped by org and repo
-        branches_by_org = {}
-        repo_count = 0
+def build_batch_branches_query(batch_size):
+    """Build a GraphQL query fetching the branches of batch_size repos of one org, aliased r0, r1, ..."""
+    variables = ''.join(f', $repo{i}: String!' for i in range(batch_size))
+    fields = '\n'.join(
+        f'  r{i}: repository(owner: $org, name: $repo{i}) {{ {REPO_BRANCHES_FIELDS} }}' for i in range(batch_size)
+    )
+    return f'query($org: String!{variables}) {{\n{fields}\n}}'
+
+def branch_staleness(repo_state, cutoff):
+    """Return {name: stale} for the branches in a repo's state other than its default branch"""
+    default_branch = repo_state.get('default_branch', 'main')  # States saved before default branches were tracked
+    return {
+        name: datetime.fromisoformat(committed_date) < cutoff
+        for name, committed_date in repo_state.get('branches', {}).items() if name != default_branch
+    }
+
+def diff_repo(org_login, repo_name, prev_repo_state, prev_cutoff, repo_state, cutoff):
+    """Return the Branches of a repository that were added, removed or changed staleness since the last run"""
+    before = branch_staleness(prev_repo_state, prev_cutoff)
+    after = branch_staleness(repo_state, cutoff)
+    changes = []
+    for name, stale in after.items():
+        if name not in before:
+            changes.append(Branch(org_login, repo_name, name, stale, 'new'))
+        elif stale != before[name]:
+            changes.append(Branch(org_login, repo_name, name, stale, 'now stale' if stale else 'updated'))
+    for name, stale in before.items():
+        if name not in after:
+            changes.append(Branch(org_login, repo_name, name, stale, 'removed'))
+    return changes
+
+async def diff_repo_states(queue, prev_orgs, prev_cutoff, cutoff):
+    """Consume (org, repo, state) items from the crawl until None, diffing each repo as it arrives
+
+    Returns this run's state by org and repo, and the branch changes as one list sorted by org, repo, then branch.
+    """
+    orgs_state = {}
+    changes = []
+    while (item := await queue.get()) is not None:
+        org_login, repo_name, repo_state = item
+        orgs_state.setdefault(org_login, {})[repo_name] = repo_state
+        prev_repo = prev_orgs.get(org_login, {}).get(repo_name, {})
+        changes.extend(diff_repo(org_login, repo_name, prev_repo, prev_cutoff, repo_state, cutoff))
+    # Repos no longer listed (deleted, archived or emptied) have all their branches removed
+    for org_login, prev_repos in prev_orgs.items():
+        for repo_name, prev_repo in prev_repos.items():
+            if repo_name not in orgs_state.get(org_login, {}):
+                changes.extend(diff_repo(org_login, repo_name, prev_repo, prev_cutoff, {}, cutoff))
+    changes.sort()
+    return orgs_state, changes
+
+def group_changes(changes):
+    """Group sorted Branches by org, then repo, for the report templates"""
+    return [
+        (org_login, [(repo_name, list(repo_changes)) for repo_name, repo_changes in groupby(org_changes, REPO)])
+        for org_login, org_changes in groupby(changes, ORG)
+    ]
+
+def parse_refs(refs):
+    """Return {branch: committedDate} for one page of refs"""
+    return {ref['name']: ref['target']['committedDate'] for ref in refs['nodes']}
+
+async def fetch_remaining_refs(session, semaphore, org_login, repo_name, cursor):
+    """Fetch the branches after the first page of a repository with more than 100 branches"""
+    branches = {}
+    while cursor:
+        data = await run_graphql_query(
+            session, REPO_BRANCHES_PAGE_QUERY, {'org': org_login, 'repo': repo_name, 'cursor': cursor}, semaphore
+        )
+        refs = data['repository']['refs']
+        branches.update(parse_refs(refs))
+        cursor = refs['pageInfo']['endCursor'] if refs['pageInfo']['hasNextPage'] else None
+    return branches
+
+async def fetch_refs_batch(session, semaphore, org_login, repo_names):
+    """Fetch the branches of a batch of repositories in one GraphQL query, returning {repo: {branch: committedDate}}"""
+    variables = {'org': org_login}
+    variables.update({f'repo{i}': repo_name for i, repo_name in enumerate(repo_names)})
+    try:
+        data = await run_graphql_query(session, build_batch_branches_query(len(repo_names)), variables, semaphore)
+        fetched = {}
+        for i, repo_name in enumerate(repo_names):
+            refs = data[f'r{i}']['refs']
+            branches = parse_refs(refs)
+            if refs['pageInfo']['hasNextPage']:
+                branches.update(
+                    await fetch_remaining_refs(session, semaphore, org_login, repo_name, refs['pageInfo']['endCursor'])
+                )
+            fetched[repo_name] = branches
+        return fetched
+    except Exception as e:
+        print(f"Error fetching branches for repos {', '.join(repo_names)}: {str(e)}")
+        return {}
+
+def build_repo_state(repo, branches):
+    """Build a repo's state from its listing node and {branch: committedDate}"""
+    return {'pushed_at': repo['pushedAt'], 'default_branch': repo['defaultBranchRef']['name'], 'branches': branches}
+
+async def process_repo_batch(session, semaphore, queue, queued, org_login, batch, prev_repos):
+    """Fetch the branches of a batch of repos pushed to since the last run and queue their state"""
+    fetched = await fetch_refs_batch(session, semaphore, org_login, [repo['name'] for repo in batch])
+    for repo in batch:
+        repo_name = repo['name']
+        if repo_name in fetched:
+            await queue.put((org_login, repo_name, build_repo_state(repo, fetched[repo_name])))
+        elif repo_name in prev_repos:
+            # Keep the last known branches so a failed fetch is not reported as removals; retried next run
+            await queue.put((org_login, repo_name, prev_repos[repo_name]))
+        queued.add(repo_name)
+
+async def process_org(session, semaphore, queue, org_login, prev_repos):
+    """Process all repositories of an organization concurrently, queueing each repo's state; returns the repo count"""
+    repos = []
+    queued = set()  # Names of the repos whose state has been queued
+    try:
+        print(f"Processing organization: {org_login}")
+        repos = await fetch_org_repos(session, semaphore, org_login)
+        changed = []
+        for repo in repos:
+            repo_name = repo['name']
+            print(f"Processing repo: {repo_name} in {org_login}")
+            prev_repo = prev_repos.get(repo_name)
+            if repo['refs']['totalCount'] <= 1:
+                # A repo with a single branch only has its default branch, so its refs need not be fetched
+                await queue.put((org_login, repo_name, build_repo_state(repo, {})))
+                queued.add(repo_name)
+            elif prev_repo and prev_repo['pushed_at'] == repo['pushedAt']:
+                # Nothing pushed since the last run, reuse its branches; the default branch can change without a push
+                await queue.put((org_login, repo_name, build_repo_state(repo, prev_repo['branches'])))
+                queued.add(repo_name)
+            else:
+                changed.append(repo)
+
+        # Fetch the repos pushed to since the last run in batches of aliased GraphQL queries; every batch runs to
+        # completion, so none can queue its repos after the crawl has ended
+        results = await asyncio.gather(*[
+            process_repo_batch(
+                session, semaphore, queue, queued, org_login, changed[i:i + REPO_BATCH_SIZE], prev_repos
+            )
+            for i in range(0, len(changed), REPO_BATCH_SIZE)
+        ], return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+    except Exception as e:
+        print(f"Error processing organization {org_login}: {str(e)}")
+        # Keep the last known state of the repos not queued yet so they are not reported as removals
+        for repo_name, prev_repo in prev_repos.items():
+            if repo_name not in queued:
+                await queue.put((org_login, repo_name, prev_repo))
+    return len(repos)
+
+async def crawl_orgs(session, semaphore, queue, orgs, prev_orgs):
+    """Produce every repo's state onto the queue, then None once all organizations are done; returns the repo count"""
+    try:
+        repo_counts = await asyncio.gather(
+            *[process_org(session, semaphore, queue, org_login, prev_orgs.get(org_login, {})) for org_login in orgs]
+        )
+    finally:
+        await queue.put(None)
+    return sum(repo_counts)
+
+async def collect_branches(github_token, prev_orgs, prev_cutoff, cutoff):
+    """Crawl all organizations concurrently, diffing repos against the previous run as their states arrive
+
+    Returns ({org: {repo: {'pushed_at', 'default_branch', 'branches'}}}, sorted branch changes, repo count).
+    """
+    headers = {
+        'Authorization': f'bearer {github_token}',
+        'Accept': 'application/vnd.github+json'
+    }
+    # Keep-alive connector so the TLS connection is reused across all calls in the run
+    connector = aiohttp.TCPConnector(limit=20, keepalive_timeout=30)
+    timeout = aiohttp.ClientTimeout(total=60)
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    async with aiohttp.ClientSession(headers=headers, connector=connector, timeout=timeout) as session:
         try:
-            check_rate_limit(g)
             print("Fetching organizations")
-            orgs = g.get_user().get_orgs()
+            orgs = await fetch_orgs(session)
         except Exception as e:
             print(f"Error fetching organizations: {str(e)}")
             raise e
 
-        for org in orgs:
-            try:
-                check_rate_limit(g)
-                print(f"Processing organization: {org.login}")
-                branches_by_org[org.login] = {}
-                for repo in org.get_repos():
-                    try:
-                        check_rate_limit(g)
-                        print(f"Processing repo: {repo.name} in {org.login}")
-                        repo_count += 1
-                        branches = repo.get_branches()
-                        for branch in branches:
-                            if branch.name != 'main':
-                                try:
-                                    check_rate_limit(g)
-                                    # Get the HEAD commit for the branch
-                                    commit = branch.commit
-                                    commit_date = commit.commit.committer.date
-                                    # Calculate age in seconds
-                                    age_seconds = (datetime.now(timezone.utc) - commit_date).total_seconds()
-                                    is_stale = age_seconds > 72 * 3600  # 72 hours in seconds
-                                    if repo.name not in branches_by_org[org.login]:
-                                        branches_by_org[org.login][repo.name] = []
-                                    branches_by_org[org.login][repo.name].append({
-                                        'branch': branch.name,
-                                        'stale': is_stale
-                                    })
-                                except Exception as e:
-                                    print(f"Error processing branch {branch.name} in repo {repo.name}: {str(e)}")
-                    except Exception as e:
-                        print(f"Error processing repo {repo.name}: {str(e)}")
-            except Exception as e:
-                print(f"Error processing organization {org.login}: {str(e)}")
+        # The crawl produces repo states while the consumer diffs them, overlapping the diff with network waits
+        queue = asyncio.Queue()
+        repo_count, (orgs_state, changes) = await asyncio.gather(
+            crawl_orgs(session, semaphore, queue, orgs, prev_orgs),
+            diff_repo_states(queue, prev_orgs, prev_cutoff, cutoff)
+        )
+    return orgs_state, changes, repo_count
+
+def lambda_handler(event, context):
+    """Lambda handler function"""
+    try:
+        # A single reference time for the whole run
+        now = datetime.now(timezone.utc)
+        ts = now.isoformat(timespec='seconds')
+
+        # Stop retrying GitHub requests early enough that the report still goes out before the Lambda times out
+        _retry_deadline[0] = time.monotonic() + context.get_remaining_time_in_millis() / 1000 - DEADLINE_MARGIN
+
+        # Environment variables
+        sender_email = os.environ['SENDER_EMAIL']
+        recipient_email = os.environ['RECIPIENT_EMAIL']
+
+        # Get GitHub token from Secrets Manager and the previous run's branches from S3 in parallel
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            token_future = executor.submit(get_github_token)
+            state_future = executor.submit(load_state)
+            github_token = token_future.result()
+            prev_state = state_future.result()
+
+        # On the first run every branch is reported as new
+        prev_state = prev_state or {'cutoff': now.isoformat(), 'orgs': {}}
+        prev_cutoff = datetime.fromisoformat(prev_state['cutoff'])
+        cutoff = now - STALE_AFTER
+
+        # Collect branches, grouped by org and repo, and diff them against the previous run
+        orgs_state, changes, repo_count = asyncio.run(
+            collect_branches(github_token, prev_state['orgs'], prev_cutoff, cutoff)
+        )
+        changes = group_changes(changes)
 
         # Prepare email content
-        if branches_by_org:
-            # Plain-text report
-            text_lines = []
-            html_lines = ['<div style="font-family: Arial, sans-serif;">']
-            for org_name, repos in sorted(branches_by_org.items()):
-                if repos:  # Only include orgs with non-main branches
-                    text_lines.append(org_name)
-                    html_lines.append(f'<h3>{org_name}</h3>')
-                    for repo_name, branches in sorted(repos.items()):
-                        text_lines.append(f"    {repo_name}")
-                        html_lines.append(f'<p style="margin-left: 20px;">{repo_name}</p>')
-                        for branch in sorted(branches, key=lambda x: x['branch']):
-                            text_lines.append(f"        {branch['branch']}, {'Y' if branch['stale'] else 'N'}")
-                            html_lines.append(
-                                f'<p style="margin-left: 40px;">{branch["branch"]}, '
-                                f'{"Y" if branch["stale"] else "N"}</p>')
-            text_lines.append(f"\nTotal repositories processed: {repo_count}")
-            html_lines.append(f'<p>Total repositories processed: {repo_count}</p>')
-            html_lines.append('</div>')
-            text_body = (
-                f"Non-main branches found as of {datetime.utcnow().isoformat()}:\n\n"
-                f"\n".join(text_lines)
-            )
-            html_body = (
-                f'<p>Non-main branches found as of {datetime.utcnow().isoformat()}:</p>'
-                f'\n{"".join(html_lines)}'
-            )
-        else:
-            text_body = (
-                f"No non-main branches found as of {datetime.utcnow().isoformat()}.\n\n"
-                f"Total repositories processed: {repo_count}"
-            )
-            html_body = (
-                f"<p>No non-main branches found as of {datetime.utcnow().isoformat()}.</p>"
-                f"<p>Total repositories processed: {repo_count}</p>"
-            )
+        text_body = _TEXT_REPORT.render(changes=changes, ts=ts, count=repo_count)
+        html_body = _HTML_REPORT.render(changes=changes, ts=ts, count=repo_count)
 
         # Send email with day and date in subject
-        subject = f"GitHub Non-Main Branches Report - {datetime.now().strftime('%A, %B %d, %Y')}"
+        subject = f"GitHub Non-Main Branches Report - {now.strftime('%A, %B %d, %Y')}"
         send_email(sender_email, recipient_email, subject, html_body, text_body)
 
+        # Only advance the state once the report has been sent, so no changes are lost
+        save_state({'cutoff': cutoff.isoformat(), 'orgs': orgs_state})
+
         return {
             'statusCode': 200,
             'body': json.dumps('Successfully processed and sent email')